@@ -1,17 +1,78 @@
+import asyncio
+import random
+import threading
+import time
+
 import streamlit as st
 import biosteam as bst
 import thermosteam as tmo
-import pandas as pd
-import google.generativeai as genai
+import numpy as np
+import pyarrow as pa
+from scipy.interpolate import RegularGridInterpolator
+import httpx
+from google import genai
+from google.genai import errors as genai_errors
+from google.genai import types as genai_types
 
 # ==========================================
 # CONFIGURACIÓN DE GEMINI
 # ==========================================
-try:
-    genai.configure(api_key=st.secrets["GEMINI_API_KEY"])
-    model = genai.GenerativeModel('gemini-2.5-flash')
-except Exception:
-    st.warning("⚠️ No se encontró la API Key de Gemini en Secrets.")
+# Preámbulo estático como system_instruction: Gemini no lo re-procesa como
+# parte del prompt en cada turno, solo viajan los números de cada corrida.
+# Instrucción corta: menos prefill por llamada. El límite de longitud va en
+# la propia instrucción y no en max_output_tokens, que con los modelos 2.5
+# puede producir streams vacíos al agotarse el presupuesto en razonamiento.
+_INSTRUCCION_PROFESOR = (
+    "Profesor de Ingeniería Química. Se simula un flash binario agua-etanol "
+    "en BioSTEAM. Responde en 4 frases como máximo."
+)
+
+@st.cache_resource
+def get_client():
+    # Un solo cliente por proceso: se reutiliza el pool de conexiones y no
+    # se repite la lectura de st.secrets en cada rerun. El SDK google-genai
+    # entrega los tokens en chunks más finos que el legacy google.generativeai.
+    return genai.Client(
+        api_key=st.secrets["GEMINI_API_KEY"],
+        http_options=genai_types.HttpOptions(timeout=_TIMEOUT_GEMINI_MS),
+    )
+
+def get_chat():
+    # El chat vive en session_state, no en cache_resource: así el historial
+    # es privado de cada sesión y no crece de por vida del proceso ni
+    # entremezcla los turnos de usuarios concurrentes.
+    if 'chat_ia' not in st.session_state:
+        st.session_state['chat_ia'] = get_client().chats.create(
+            model='gemini-2.5-flash',
+            config=genai_types.GenerateContentConfig(
+                system_instruction=_INSTRUCCION_PROFESOR),
+        )
+    return st.session_state['chat_ia']
+
+# Las latencias de Gemini tienen mucha varianza; sin timeout una llamada
+# lenta congela la sesión de Streamlit. 15 s + 2 reintentos acota el p99.
+_TIMEOUT_GEMINI_MS = 15_000
+_MAX_INTENTOS_GEMINI = 3
+# Solo errores transitorios: 5xx del API y fallos de transporte httpx
+# (timeouts, ConnectError, RemoteProtocolError, ...). Los 4xx (API key
+# inválida, petición mal formada) no se reintentan: no se arreglan solos.
+_ERRORES_GEMINI = (genai_errors.ServerError, httpx.HTTPError)
+
+def _suavizar_stream(stream):
+    # Gemini a veces emite "mega-chunks" de cientos de caracteres, lo que
+    # produce un render a saltos. Trocear a ~4 caracteres con una pausa de
+    # 20 ms (~62 tokens/s) da una cadencia de escritura fluida.
+    for chunk in stream:
+        # Los chunks de metadatos/cierre no llevan texto (chunk.text es None).
+        texto = chunk if isinstance(chunk, str) else (chunk.text or '')
+        if not texto:
+            continue
+        if len(texto) > 50:
+            for i in range(0, len(texto), 4):
+                yield texto[i:i + 4]
+                time.sleep(0.02)
+        else:
+            yield texto
 
 # ==========================================
 # INTERFAZ DE STREAMLIT
@@ -22,28 +83,42 @@ st.title("🧪 Planta de Etanol con Reciclo Energético")
 # --- SIDEBAR: PARÁMETROS DINÁMICOS ---
 with st.sidebar:
     st.header("⚙️ Parámetros de Control")
-    f_mass_total = st.slider("Flujo Alimentación (kg/h)", 500, 2000, 1000)
-    t_e100_out = st.slider("Temp. Salida E-100 (°C)", 70, 90, 85)
-    t_e101_out = st.slider("Temp. Salida E-101 (°C)", 85, 98, 92)
-    p_flash_atm = st.slider("Presión V-102 (atm)", 0.5, 1.5, 1.0)
-    
-    st.divider()
-    btn_simular = st.button("🚀 Ejecutar Simulación e IA", type="primary")
+    # st.form: mover los sliders no relanza el script; solo el botón de
+    # envío dispara un rerun con los cuatro valores ya ajustados.
+    with st.form("parametros"):
+        f_mass_total = st.slider("Flujo Alimentación (kg/h)", 500, 2000, 1000)
+        t_e100_out = st.slider("Temp. Salida E-100 (°C)", 70, 90, 85)
+        t_e101_out = st.slider("Temp. Salida E-101 (°C)", 85, 98, 92)
+        p_flash_atm = st.slider("Presión V-102 (atm)", 0.5, 1.5, 1.0)
+
+        btn_simular = st.form_submit_button("🚀 Ejecutar Simulación e IA",
+                                            type="primary")
 
 # ==========================================
 # LÓGICA DE SIMULACIÓN
 # ==========================================
-def ejecutar_simulacion(f_total, t_e100, t_e101, p_atm):
-    # --- SOLUCIÓN AL ERROR DE ID: Limpiar flowsheet ---
-    bst.main_flowsheet.clear() 
-    # --------------------------------------------------
-    
-    # 1. SETUP
+@st.cache_resource
+def _get_chemicals():
+    # Construir los Chemicals y fijar el thermo es puro setup (parseo de CAS,
+    # objetos de propiedades): basta hacerlo una vez por proceso.
     chemicals = tmo.Chemicals(['Water', 'Ethanol'])
     bst.settings.set_thermo(chemicals)
-    
-    # 2. STREAMS
-    f_kmol = f_total / 20.82
+    return chemicals
+
+@st.cache_resource
+def _build_system():
+    # La topología es fija: construir unidades y registrar el flowsheet una
+    # sola vez por proceso. Cada simulación solo re-especifica parámetros.
+    # Flowsheet propio de la app en lugar de vaciar el registro global: las
+    # unidades se registran una única vez y nada se invalida entre corridas
+    # (y los IDs no pueden chocar con lo que hubiera en main_flowsheet).
+    bst.main_flowsheet.set_flowsheet(bst.Flowsheet('app_fs'))
+
+    # 1. SETUP
+    _get_chemicals()
+
+    # 2. STREAMS (los flujos se re-especifican en cada corrida)
+    f_kmol = 1000 / 20.82
     mosto = bst.Stream('mosto_feed', # ID interno único
                        Water=f_kmol*0.9, Ethanol=f_kmol*0.1, units='kmol/hr',
                        T=25 + 273.15, P=101325)
@@ -54,82 +129,307 @@ def ejecutar_simulacion(f_total, t_e100, t_e101, p_atm):
 
     # 3. EQUIPOS
     P100 = bst.Pump('P100', ins=mosto, P=4 * 101325)
-    E100 = bst.HXprocess('E100', ins=(P100-0, vinazas_retorno), 
+    E100 = bst.HXprocess('E100', ins=(P100-0, vinazas_retorno),
                          outs=('mosto_pre', 'drenaje'), phase0='l', phase1='l')
-    E100.outs[0].T = t_e100 + 273.15
 
-    E101 = bst.HXutility('E101', ins=E100-0, T=t_e101 + 273.15)
-    V100 = bst.IsenthalpicValve('V100', ins=E101-0, outs='mezcla_bifasica', P=p_atm * 101325)
-    V102 = bst.Flash('V102', ins=V100-0, outs=('vapor_caliente', 'vinazas'), P=p_atm * 101325, Q=0)
+    E101 = bst.HXutility('E101', ins=E100-0, T=92 + 273.15)
+    V100 = bst.IsenthalpicValve('V100', ins=E101-0, outs='mezcla_bifasica', P=101325)
+    V102 = bst.Flash('V102', ins=V100-0, outs=('vapor_caliente', 'vinazas'), P=101325, Q=0)
     E102 = bst.HXutility('E102', ins=V102-0, outs='producto_final', T=25 + 273.15)
     P101 = bst.Pump('P101', ins=V102-1, outs=vinazas_retorno, P=3 * 101325)
 
     # 4. SISTEMA
     eth_sys = bst.System('eth_sys', path=(P100, E100, E101, V100, V102, E102, P101))
-    eth_sys.simulate()
-    
+
+    return eth_sys, mosto, vinazas_retorno, E100, E101, V100, V102
+
+# El sistema cacheado se comparte entre todas las sesiones: mutar las
+# especificaciones, simular y leer los resultados debe ser atómico o dos
+# clics concurrentes se pisan las corridas (cache_resource exige objetos
+# thread-safe). Reentrante para que los lectores abarquen la simulación.
+_SIM_LOCK = threading.RLock()
+
+def ejecutar_simulacion(f_total, t_e100, t_e101, p_atm):
+    eth_sys, mosto, vinazas_retorno, E100, E101, V100, V102 = _build_system()
+
+    with _SIM_LOCK:
+        f_kmol = f_total / 20.82
+        mosto.imol['Water'] = f_kmol * 0.9
+        mosto.imol['Ethanol'] = f_kmol * 0.1
+        vinazas_retorno.imol['Water'] = f_kmol * 0.9
+        vinazas_retorno.imol['Ethanol'] = 0
+        # P101 sobrescribe T/P de esta corriente en cada simulate(); sin
+        # recirculación declarada el paso es único, así que hay que restaurar
+        # el estado inicial o la corrida N hereda el de la corrida N-1.
+        vinazas_retorno.T = 95 + 273.15
+        vinazas_retorno.P = 300000
+
+        E100.outs[0].T = t_e100 + 273.15
+        E101.T = t_e101 + 273.15
+        V100.P = p_atm * 101325
+        V102.P = p_atm * 101325
+
+        eth_sys.simulate()
+
     return eth_sys
 
+# Malla de los sliders del flash: T entera y P a 0.1 atm bastan porque la
+# respuesta del flash es suave en (T, P); el resto lo cubre la interpolación.
+_GRID_T = np.arange(85.0, 99.0, 1.0)
+_GRID_P = np.arange(0.5, 1.55, 0.1)
+
+@st.cache_resource
+def _interpolador_pureza():
+    # La pureza es intensiva: no depende del flujo total ni de la T de E-100
+    # (E-101 fija el estado de entrada al flash), solo de (T, P) del flash.
+    # 14x11 corridas del sistema cacheado, una sola vez por proceso.
+    pureza = np.empty((_GRID_T.size, _GRID_P.size))
+    for i, t in enumerate(_GRID_T):
+        for j, p in enumerate(_GRID_P):
+            with _SIM_LOCK:
+                sistema = ejecutar_simulacion(1000, 85, t, p)
+                prod = sistema.flowsheet.stream.producto_final
+                # En las esquinas frías/presurizadas la alimentación queda por
+                # debajo del punto de burbuja y el vapor sale vacío: 0/0.
+                pureza[i, j] = (prod.imass['Ethanol'] / prod.F_mass
+                                if prod.F_mass > 0 else 0.0)
+    return RegularGridInterpolator((_GRID_T, _GRID_P), pureza)
+
+# Formato diferido: las tablas viajan como Arrow con columnas numéricas
+# crudas y el frontend de Streamlit aplica el formato por columna.
+_CONFIG_MATERIA = {
+    'Temp (°C)': st.column_config.NumberColumn(format="%.2f"),
+    'Presión (bar)': st.column_config.NumberColumn(format="%.2f"),
+    'Flujo (kg/h)': st.column_config.NumberColumn(format="%.1f"),
+    '% Etanol': st.column_config.NumberColumn(format="%.1f%%"),
+}
+_CONFIG_ENERGIA = {
+    'Energía (kW)': st.column_config.NumberColumn(format="%.2f"),
+}
+
 def generar_reporte_streamlit(sistema):
-    datos_mat = []
-    for s in sistema.streams:
-        if s.F_mass > 0.001:
-            datos_mat.append({
-                'ID Corriente': s.ID,
-                'Temp (°C)': f"{s.T - 273.15:.2f}",
-                'Presión (bar)': f"{s.P/1e5:.2f}",
-                'Flujo (kg/h)': f"{s.F_mass:.1f}",
-                '% Etanol': f"{s.imass['Ethanol']/s.F_mass:.1%}" if s.F_mass > 0 else "0%"
-            })
-    
-    datos_en = []
+    # SoA: una columna tipada por magnitud, llenada en una sola pasada sobre
+    # las corrientes; el filtro de corrientes vacías se aplica vectorizado.
+    streams = sistema.streams
+    n = len(streams)
+    ids = []
+    T = np.empty(n)
+    P = np.empty(n)
+    F = np.empty(n)
+    etanol = np.empty(n)
+    agregar_id = ids.append
+    for i, s in enumerate(streams):
+        agregar_id(s.ID)
+        T[i] = s.T
+        P[i] = s.P
+        F[i] = s.F_mass
+        etanol[i] = s.imass['Ethanol']
+
+    con_flujo = F > 1e-3
+    tabla_mat = pa.table({
+        'ID Corriente': pa.array([id_ for id_, ok in zip(ids, con_flujo) if ok],
+                                 pa.string()),
+        'Temp (°C)': pa.array(T[con_flujo] - 273.15, pa.float64()),
+        'Presión (bar)': pa.array(P[con_flujo] / 1e5, pa.float64()),
+        'Flujo (kg/h)': pa.array(F[con_flujo], pa.float64()),
+        '% Etanol': pa.array(etanol[con_flujo] / F[con_flujo] * 100, pa.float64()),
+    })
+
+    equipos = []
+    energias = []
     for u in sistema.units:
         calor_kw = 0.0
-        if hasattr(u, 'heat_utilities') and u.heat_utilities:
-            calor_kw = sum(h.duty for h in u.heat_utilities) / 3600
+        utilidades = getattr(u, 'heat_utilities', None)
+        if utilidades:
+            duties = np.fromiter((h.duty for h in utilidades), float)
+            calor_kw = duties.sum() / 3600
         elif isinstance(u, bst.HXprocess):
-            calor_kw = (u.outs[0].H - u.ins[0].H) / 3600
+            # .H es una propiedad costosa de thermosteam: evaluarla una vez.
+            h_salida = u.outs[0].H
+            h_entrada = u.ins[0].H
+            calor_kw = (h_salida - h_entrada) / 3600
 
         if abs(calor_kw) > 0.01:
-            datos_en.append({'Equipo': u.ID, 'Energía (kW)': round(calor_kw, 2)})
-            
-    return pd.DataFrame(datos_mat), pd.DataFrame(datos_en)
+            equipos.append(u.ID)
+            energias.append(calor_kw)
+
+    tabla_en = pa.table({
+        'Equipo': pa.array(equipos, pa.string()),
+        'Energía (kW)': pa.array(energias, pa.float64()),
+    })
+
+    return tabla_mat, tabla_en
+
+@st.cache_data(max_entries=64)
+def _simular_core(f_total, t_e100, t_e101, p_atm):
+    # Núcleo memoizado: la misma tupla de sliders devuelve el resultado
+    # cacheado sin repetir la convergencia del flash. Solo se devuelven
+    # valores picklables (nada de objetos Flash/System).
+    with _SIM_LOCK:
+        sistema = ejecutar_simulacion(f_total, t_e100, t_e101, p_atm)
+        tabla_mat, tabla_en = generar_reporte_streamlit(sistema)
+
+        prod = sistema.flowsheet.stream.producto_final
+        pureza = prod.imass['Ethanol'] / prod.F_mass if prod.F_mass > 0 else 0.0
+
+    return {'materia': tabla_mat, 'energia': tabla_en, 'pureza': pureza}
+
+def _simular_y_consultar(chat, mensaje, f_total, t_e100, t_e101, p_atm):
+    # Lanza la petición a Gemini en paralelo con la simulación BioSTEAM:
+    # la latencia total pasa a ser max(sim, LLM) en lugar de la suma.
+    def _iniciar_stream():
+        # send_message_stream es perezoso: consumir el primer chunk fuerza el
+        # envío, de modo que el TTFT se solapa con la simulación.
+        stream = chat.send_message_stream(mensaje)
+        primero = next(stream, None)
+        return primero, stream
+
+    async def _paralelo():
+        # El gather se crea dentro de la corrutina: así las tareas quedan
+        # ligadas al loop que las ejecuta (el hilo de Streamlit no tiene
+        # un event loop propio del que puedan colgarse).
+        sim = asyncio.to_thread(_simular_core, f_total, t_e100, t_e101, p_atm)
+        llm = asyncio.to_thread(_iniciar_stream)
+        return await asyncio.gather(sim, llm, return_exceptions=True)
+
+    loop = asyncio.new_event_loop()
+    try:
+        resultado, inicio = loop.run_until_complete(_paralelo())
+        if isinstance(resultado, BaseException):
+            raise resultado
+    finally:
+        loop.close()
+
+    def _chunks():
+        # Drena el stream ya iniciado. Si la llamada agota el timeout,
+        # reintenta con backoff y jitter; el texto parcial ya emitido
+        # permanece en pantalla.
+        for intento in range(_MAX_INTENTOS_GEMINI):
+            try:
+                if intento == 0:
+                    if isinstance(inicio, BaseException):
+                        raise inicio
+                    primero, stream = inicio
+                    if primero is not None:
+                        yield primero
+                    for chunk in stream:
+                        yield chunk
+                else:
+                    for chunk in chat.send_message_stream(mensaje):
+                        yield chunk
+                return
+            except genai_errors.ClientError as e:
+                yield (f"\n\n❌ Gemini rechazó la petición ({e.code}): "
+                       "revisa la API key o la configuración.")
+                return
+            except _ERRORES_GEMINI:
+                if intento == _MAX_INTENTOS_GEMINI - 1:
+                    yield ("\n\n⏳ Gemini no respondió a tiempo; "
+                           "se muestra solo la respuesta parcial.")
+                    return
+                time.sleep(random.uniform(0.5, 1.5 * 2 ** intento))
+
+    return resultado, _chunks()
+
+def _explicacion_stream(chat, mensaje):
+    # Variante síncrona (para re-explicar sin re-simular), con el mismo
+    # timeout y reintentos que la ruta paralela.
+    for intento in range(_MAX_INTENTOS_GEMINI):
+        try:
+            for chunk in chat.send_message_stream(mensaje):
+                yield chunk
+            return
+        except genai_errors.ClientError as e:
+            yield (f"\n\n❌ Gemini rechazó la petición ({e.code}): "
+                   "revisa la API key o la configuración.")
+            return
+        except _ERRORES_GEMINI:
+            if intento == _MAX_INTENTOS_GEMINI - 1:
+                yield ("\n\n⏳ Gemini no respondió a tiempo; "
+                       "se muestra solo la respuesta parcial.")
+                return
+            time.sleep(random.uniform(0.5, 1.5 * 2 ** intento))
+
+@st.fragment
+def panel_ia(chunks=None):
+    # Fragmento aislado: "Volver a explicar" re-ejecuta solo este bloque,
+    # sin repetir la simulación BioSTEAM ni el resto del script.
+    st.subheader("🤖 Análisis del Profesor Gemini")
+    regenerar = st.button("🔁 Volver a explicar")
+    with st.chat_message("assistant"):
+        if regenerar and 'mensaje_ia' in st.session_state:
+            chunks = _explicacion_stream(get_chat(), st.session_state['mensaje_ia'])
+        if chunks is not None:
+            texto = st.write_stream(_suavizar_stream(chunks))
+            if texto:
+                st.session_state['explicacion_ia'] = texto
+        elif 'explicacion_ia' in st.session_state:
+            st.markdown(st.session_state['explicacion_ia'])
 
 # --- EJECUCIÓN ---
+entradas = (f_mass_total, t_e100_out, t_e101_out, p_flash_atm)
+chunks = None
+
+if btn_simular:
+    # Debounce: un doble clic lanzaría dos simulaciones (y dos llamadas a
+    # Gemini) seguidas; se ignora cualquier envío a menos de 0.5 s del previo
+    # pero se sigue hasta el bloque de render para no borrar lo ya mostrado.
+    ahora = time.monotonic()
+    if ahora - st.session_state.get('_ultima_sim', 0.0) < 0.5:
+        btn_simular = False
+    else:
+        st.session_state['_ultima_sim'] = ahora
+
 if btn_simular:
     try:
+        try:
+            chat = get_chat()
+        except Exception:
+            chat = None
+            st.warning("⚠️ No se encontró la API Key de Gemini en Secrets.")
+
         with st.spinner("Simulando proceso..."):
-            sistema = ejecutar_simulacion(f_mass_total, t_e100_out, t_e101_out, p_flash_atm)
-            df_m, df_e = generar_reporte_streamlit(sistema)
-            
-            col1, col2 = st.columns(2)
-            with col1:
-                st.subheader("Balance de Materia")
-                st.dataframe(df_m, use_container_width=True)
-            with col2:
-                st.subheader("Requerimientos Energéticos")
-                st.dataframe(df_e, use_container_width=True)
-
-            # --- EXPLICACIÓN IA ---
-            st.divider()
-            st.subheader("🤖 Análisis del Profesor Gemini")
-            
-            # Recuperar corriente de producto por posición o ID
-            prod = sistema.flowsheet.stream.producto_final
-            pureza = prod.imass['Ethanol'] / prod.F_mass if prod.F_mass > 0 else 0
-            
-            prompt = f"""
-            Como experto en ingeniería química, analiza estos resultados de BioSTEAM:
-            - Temperatura Flash: {t_e101_out}°C.
-            - Presión Flash: {p_flash_atm} atm.
-            - Pureza de etanol: {pureza:.2%}.
-            
-            Explica la relación entre la presión y la pureza en este sistema binario.
-            """
-            
-            with st.chat_message("assistant"):
-                response = model.generate_content(prompt)
-                st.markdown(response.text)
-                
+            if chat is not None:
+                # Turno preliminar: la pureza sale de la malla precalculada
+                # (sub-ms una vez construida; el primer clic paga el barrido,
+                # por eso va dentro del spinner), así la consulta lleva el
+                # dato sin esperar a la simulación completa. Sin API key no
+                # hay consulta, así que tampoco se construye la malla.
+                pureza_estimada = float(
+                    _interpolador_pureza()((t_e101_out, p_flash_atm)))
+                mensaje = (f"T={t_e101_out}°C, P={p_flash_atm} atm, "
+                           f"alimentación={f_mass_total} kg/h, "
+                           f"pureza≈{pureza_estimada:.1%}. "
+                           "¿Por qué, y qué efecto tiene subir P en la pureza?")
+                st.session_state['mensaje_ia'] = mensaje
+                resultado, chunks = _simular_y_consultar(
+                    chat, mensaje, f_mass_total, t_e100_out, t_e101_out, p_flash_atm)
+            else:
+                resultado = _simular_core(f_mass_total, t_e100_out, t_e101_out, p_flash_atm)
+
+        # Persistir el resultado junto con sus entradas: los reruns que no
+        # vienen del botón (p. ej. interacción con el panel IA) solo
+        # re-renderizan, sin tocar la simulación.
+        st.session_state['resultado_sim'] = (entradas, resultado)
     except Exception as e:
         st.error(f"Error en la simulación: {e}")
+
+guardado = st.session_state.get('resultado_sim')
+if guardado is not None:
+    entradas_guardadas, resultado = guardado
+    if entradas_guardadas == entradas:
+        col1, col2 = st.columns(2)
+        with col1:
+            st.subheader("Balance de Materia")
+            st.dataframe(resultado['materia'], column_config=_CONFIG_MATERIA,
+                         use_container_width=True)
+        with col2:
+            st.subheader("Requerimientos Energéticos")
+            st.dataframe(resultado['energia'], column_config=_CONFIG_ENERGIA,
+                         use_container_width=True)
+
+        # --- EXPLICACIÓN IA ---
+        st.divider()
+        panel_ia(chunks)
+    else:
+        st.info("Parámetros modificados: pulsa 🚀 para re-simular.")